@@ -1,60 +1,281 @@
 import streamlit as st
 import pandas as pd
-import random
-import time
-import snowflake.connector
-import uuid
+import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from numba import config as numba_config, njit, prange
+from sqlalchemy import create_engine, event
+from snowflake.connector.errors import DatabaseError, InterfaceError
+from snowflake.sqlalchemy import URL
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ---- Race Constants ----
 RACE_FEE = 1000  # Entry fee for the race
 PRIZE_MONEY = 5000  # Prize money for the winner
+RESULTS_LIMIT = 100  # Number of fastest cars kept and shown in the race results
+PAGE_SIZE = 100  # Rows sent to the browser per table page
+
+# ---- Column Types ----
+# Numeric columns are cast once at load time, so no Decimal values ever reach the race maths
+TEAM_DTYPES = {'BUDGET': 'Int64'}  # Nullable, so teams with a NULL budget still load
+CAR_DTYPES = {'TOP_SPEED': 'float64', 'ACCELERATION': 'float64', 'HANDLING': 'float64'}
+
+# ---- Queries ----
+TEAMS_QUERY = "SELECT * FROM TEAMS.TEAMS"
+# Team names are joined onto cars in the warehouse, so the race needs no client-side merge
+CARS_QUERY = (
+    "SELECT c.*, t.TEAM_NAME FROM CARS.CARS c "
+    "LEFT JOIN TEAMS.TEAMS t ON c.ASSIGNED_TEAM_ID = t.TEAM_ID"
+)
 
 # ---- Streamlit Page Configuration ----
 st.set_page_config(layout="wide", page_title="Race Simulator")
 st.title("🏎️ Race Simulator")
 st.write("Welcome to the simulator! Enter team and car data to get started.")
 
-# ---- Snowflake Connection Function ----
-# We use Streamlit's cache to create a single, efficient connection to Snowflake.
+# ---- Snowflake Connection Functions ----
+class ConnectionFailed:
+    """Cached in place of an engine when connecting fails, so reruns don't retry the connection."""
+    def __bool__(self):
+        return False
+
+# We use Streamlit's cache to create a single connection pool to Snowflake, shared by all sessions.
 @st.cache_resource
-def get_snowflake_connection():
-    """Establishes and caches a connection to Snowflake using st.secrets."""
+def get_snowflake_engine():
+    """Creates and caches a pooled SQLAlchemy engine for Snowflake using st.secrets."""
     try:
-        conn_params = {
-            "user": st.secrets["snowflake"]["user"],
-            "password": st.secrets["snowflake"]["password"],
-            "account": st.secrets["snowflake"]["account"],
-            "warehouse": st.secrets["snowflake"]["warehouse"],
-            "database": st.secrets["snowflake"]["database"]
-        }
-
-        conn = snowflake.connector.connect(**conn_params)
-        return conn
+        engine = create_engine(
+            URL(
+                user=st.secrets["snowflake"]["user"],
+                password=st.secrets["snowflake"]["password"],
+                account=st.secrets["snowflake"]["account"],
+                warehouse=st.secrets["snowflake"]["warehouse"],
+                database=st.secrets["snowflake"]["database"]
+            ),
+            pool_size=5, # Up to 5 sessions can query Snowflake at the same time
+            max_overflow=0, # Never open more connections than the pool holds
+            pool_recycle=-1, # Keep authenticated connections for as long as they work
+            pool_timeout=120, # Wait up to 2 minutes for a free connection
+            # Bind parameters on the server, so each statement keeps the same SQL text
+            # and Snowflake can reuse its compiled plan
+            connect_args={
+                "paramstyle": "qmark",
+                "client_session_keep_alive": True, # Stop idle sessions expiring and forcing a re-auth
+                "client_prefetch_threads": 4, # Download result chunks in parallel
+                "network_timeout": 30 # Fail fast instead of hanging on a dead network
+            }
+        )
+
+        @event.listens_for(engine, "connect")
+        def set_arrow_result_format(dbapi_conn, _):
+            # Make sure query results come back as Arrow so they decode straight into pandas
+            dbapi_conn.cursor().execute("ALTER SESSION SET PYTHON_CONNECTOR_QUERY_RESULT_FORMAT = 'ARROW'")
+
+        # The engine connects lazily, so open one connection now to surface bad credentials here
+        engine.raw_connection().close()
+        return engine
     except Exception as e:
         st.error(f"Failed to connect to Snowflake. Please check your credentials in secrets.toml: {e}")
-        return None
+        return ConnectionFailed()
 
-# ---- Data Loading Function ----
-@st.cache_data(ttl=60) # Cache data for 60 seconds to avoid unnecessary queries
-def load_data(conn):
-    """Loads all team and car data from Snowflake."""
-    if conn is None:
-        return pd.DataFrame(), pd.DataFrame()
+@contextmanager
+def snowflake_connection(engine):
+    """Checks a Snowflake connection out of the pool and returns it to the pool when done."""
+    conn = engine.raw_connection()
+    try:
+        yield conn
+    except (DatabaseError, InterfaceError):
+        # Raw DB-API errors bypass SQLAlchemy's disconnect handling, and pool_recycle=-1 never
+        # retires a connection, so drop it rather than hand a possibly broken one out again
+        conn.invalidate()
+        raise
+    finally:
+        conn.close()
 
-    teams_query = "SELECT * FROM TEAMS.TEAMS"
-    cars_query = "SELECT * FROM CARS.CARS"
-    
+def fetch_dataframe(engine, query, dtypes=None):
+    """Runs a query on a pooled connection and returns the result as a DataFrame with the given column types."""
+    with snowflake_connection(engine) as conn:
+        df = conn.cursor().execute(query).fetch_pandas_all()
+    if dtypes and not df.empty:
+        df = df.astype(dtypes)
+    return df
+
+# ---- Data Version Counters ----
+# Shared by every session, so a write made in one session invalidates the cache for all of them.
+# Each table has its own counter, so a write only reloads the table it changed.
+@st.cache_resource
+def get_data_versions():
+    """Returns the process-wide per-table counters that are bumped after every write to Snowflake."""
+    return {"teams": 0, "cars": 0, "lock": threading.Lock()}
+
+def bump_data_version(table):
+    """Invalidates one table's cached data by moving its loader on to a new cache key."""
+    data_versions = get_data_versions()
+    # Sessions write concurrently, and a lost bump would leave stale data cached for good
+    with data_versions["lock"]:
+        data_versions[table] += 1
+
+# ---- Data Loading Functions ----
+# Errors are raised rather than caught in the loaders, so a failed load is never cached.
+# Versions only go up, so only the latest entry is kept; older ones would never be read again.
+@st.cache_data(ttl=None, max_entries=1) # Cached until a write bumps the teams version
+def load_teams(_engine, version):
+    """Loads all team data from Snowflake for the given teams version."""
+    return fetch_dataframe(_engine, TEAMS_QUERY, TEAM_DTYPES)
+
+@st.cache_data(ttl=None, max_entries=1) # Cached until a write bumps the cars version
+def load_cars(_engine, version):
+    """Loads all car data, with team names, from Snowflake for the given cars version."""
+    return fetch_dataframe(_engine, CARS_QUERY, CAR_DTYPES)
+
+def load_tables(engine, teams_version, cars_version):
+    """Loads teams and cars through their cached loaders, fetching both at the same time on a cold cache."""
+    ctx = get_script_run_ctx()
+
+    def run_in_script_context(loader, version):
+        # Cached functions need the session's script context, which worker threads lack by default
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return loader(engine, version)
+
+    # Each loader runs on its own pooled connection, so a cold start costs one round-trip, not two
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        teams_future = executor.submit(run_in_script_context, load_teams, teams_version)
+        cars_future = executor.submit(run_in_script_context, load_cars, cars_version)
+        return teams_future.result(), cars_future.result()
+
+@st.cache_data(max_entries=1)
+def team_name_list(_teams_df, version):
+    """Returns the unique team names for the given teams version."""
+    return _teams_df['TEAM_NAME'].unique().tolist()
+
+# ---- Race Functions ----
+@st.cache_resource
+def get_rng():
+    """Returns the process-wide random generator used for race-time variation."""
+    return np.random.default_rng()
+
+# Streamlit re-executes this script on every rerun, so the kernel is built inside a cached
+# resource; otherwise every rerun would create a new dispatcher and compile it again.
+@st.cache_resource
+def get_race_kernel():
+    """Returns the JIT-compiled kernel that computes race times in a single parallel pass."""
+    # Every session thread shares this kernel. The default fallback layer (workqueue) aborts the
+    # process on concurrent launches, so require a layer that is safe to call from many threads.
+    numba_config.THREADING_LAYER = 'threadsafe'
+
+    # No fastmath: it lets the compiler assume there are no NaNs, and NULL stats arrive as NaN
+    @njit(parallel=True)
+    def race_times(top_speed, acceleration, handling, j1, j2, j3, out):
+        for i in prange(top_speed.size):
+            out[i] = 100.0 / (top_speed[i] * (1 + j1[i])) + \
+                     10.0 / (acceleration[i] * (1 + j2[i])) + \
+                     10.0 / (handling[i] * (1 + j3[i]))
+    return race_times
+
+def compute_race_times(cars, rng):
+    """Returns the race time of every car, with up to 10% random variation on each stat."""
+    top_speed = cars['TOP_SPEED'].to_numpy(dtype=np.float64)
+    acceleration = cars['ACCELERATION'].to_numpy(dtype=np.float64)
+    handling = cars['HANDLING'].to_numpy(dtype=np.float64)
+    j1, j2, j3 = rng.uniform(-0.1, 0.1, (3, len(cars)))
+    times = np.empty(len(cars), dtype=np.float64)
+    get_race_kernel()(top_speed, acceleration, handling, j1, j2, j3, times)
+    return times
+
+def run_race(cars, limit):
+    """Races every car and returns the `limit` fastest results, in no particular order."""
+    times = compute_race_times(cars, get_rng())
+    leaders = np.arange(len(times))
+    if len(times) > limit:
+        # Partial selection in O(n); only the leaders are fully sorted, for display
+        leaders = np.argpartition(times, limit - 1)[:limit]
+    return pd.DataFrame({
+        "Car Model": cars['CAR_MODEL'].to_numpy()[leaders],
+        "Team": cars['TEAM_NAME'].to_numpy()[leaders],
+        "Time": times[leaders],
+        "Team ID": cars['ASSIGNED_TEAM_ID'].to_numpy()[leaders]
+    })
+
+# ---- Display Functions ----
+def render_paginated(df, name, page_size=PAGE_SIZE):
+    """Shows one page of a DataFrame, so only that slice is serialized and sent to the browser."""
+    page_count = max(1, -(-len(df) // page_size))
+    key = f"page_{name}"
+    page = 1
+    if page_count > 1:
+        # Clamp a page remembered from a larger frame before the widget reads it
+        if st.session_state.get(key, 1) > page_count:
+            st.session_state[key] = page_count
+        page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, key=key)
+    offset = (page - 1) * page_size
+    st.dataframe(df.iloc[offset:offset + page_size], use_container_width=True)
+
+# ---- Button Callbacks ----
+# Callbacks run before the script reruns, so the version bump is seen by the loaders
+# on that same rerun and no explicit rerun is needed.
+def save_pending_teams(engine):
+    """Inserts all queued teams into the TEAMS table in a single round-trip."""
+    pending_teams = st.session_state.pending_team_inserts
     try:
-        teams_df = pd.read_sql(teams_query, conn)
-        cars_df = pd.read_sql(cars_query, conn)
-        return teams_df, cars_df
+        # Team IDs are minted by Snowflake as the rows are inserted
+        with snowflake_connection(engine) as conn:
+            conn.cursor().executemany(
+                "INSERT INTO TEAMS.TEAMS (TEAM_ID, TEAM_NAME, MEMBERS_COUNT, BUDGET) VALUES (UUID_STRING(), ?, 0, ?)",
+                pending_teams
+            )
+            conn.commit()
+        st.success(f"{len(pending_teams)} team(s) have been added to Snowflake!")
+        st.session_state.pending_team_inserts = []
+        bump_data_version("teams") # Reload teams only
     except Exception as e:
-        st.error(f"Failed to load data from Snowflake: {e}")
-        return pd.DataFrame(), pd.DataFrame()
+        st.error(f"Failed to add teams: {e}")
+
+def add_car(engine):
+    """Inserts the car described by the Add a Car form into the CARS table."""
+    car_model = st.session_state.car_model
+    if not car_model:
+        return
+    try:
+        team_id = st.session_state.teams_by_name.at[st.session_state.assigned_team, 'TEAM_ID']
+        with snowflake_connection(engine) as conn:
+            conn.cursor().execute(
+                "INSERT INTO CARS.CARS (CAR_ID, CAR_MODEL, TOP_SPEED, ACCELERATION, HANDLING, ASSIGNED_TEAM_ID) VALUES (UUID_STRING(), ?, ?, ?, ?, ?)",
+                (car_model, st.session_state.top_speed, st.session_state.acceleration, st.session_state.handling, team_id)
+            )
+            conn.commit()
+        st.success(f"Car '{car_model}' has been added to Snowflake!")
+        bump_data_version("cars") # Reload cars only
+    except Exception as e:
+        st.error(f"Failed to add car: {e}")
 
 # ---- Main Application Logic ----
-conn = get_snowflake_connection()
-teams_df, cars_df = load_data(conn)
+engine = get_snowflake_engine()
+if not engine:
+    # The failure stays cached until the user explicitly asks to try again
+    st.button("Retry Connection", on_click=get_snowflake_engine.clear)
+# Versions are read once per rerun, so every cache keyed on them agrees on the frames they describe
+data_versions = get_data_versions()
+teams_version, cars_version = data_versions["teams"], data_versions["cars"]
+teams_df, cars_df = pd.DataFrame(), pd.DataFrame()
+if engine:
+    try:
+        teams_df, cars_df = load_tables(engine, teams_version, cars_version)
+    except Exception as e:
+        st.error(f"Failed to load data from Snowflake: {e}")
+
+# Index teams by name for O(1) lookups, rebuilt only when the teams version changes.
+# An empty fallback frame from a failed load is never recorded against a version.
+if teams_df.empty:
+    st.session_state.teams_by_name = None
+    st.session_state.teams_by_name_version = None
+elif st.session_state.get('teams_by_name_version') != teams_version:
+    st.session_state.teams_by_name = teams_df.drop_duplicates('TEAM_NAME').set_index('TEAM_NAME')
+    st.session_state.teams_by_name_version = teams_version
+
+# Teams added in this session that have not been written to Snowflake yet
+if 'pending_team_inserts' not in st.session_state:
+    st.session_state.pending_team_inserts = []
 
 # ---- Data Input for Teams and Cars ----
 # Container for adding a new team
@@ -66,52 +287,39 @@ with st.container(border=True):
     with col2:
         budget = st.number_input("Team Budget", min_value=0, value=50000)
     
-    # Button to add the new team to the Snowflake table
+    # Button to queue the new team; queued teams are written to Snowflake in one batch
     if st.button("Add Team"):
-        if team_name and conn:
-            try:
-                cursor = conn.cursor()
-                # Insert data into the TEAMS table
-                cursor.execute(f"INSERT INTO TEAMS.TEAMS (TEAM_ID, TEAM_NAME, MEMBERS_COUNT, BUDGET) VALUES ('{uuid.uuid4()}', '{team_name}', 0, {budget})")
-                conn.commit()
-                st.success(f"Team '{team_name}' has been added to Snowflake!")
-                st.cache_data.clear() # Clear cache to force data reload
-                st.experimental_rerun()
-            except Exception as e:
-                st.error(f"Failed to add team: {e}")
+        if team_name:
+            st.session_state.pending_team_inserts.append((team_name, budget))
+
+    pending_teams = st.session_state.pending_team_inserts
+    if pending_teams:
+        st.info(f"Teams waiting to be saved: {', '.join(name for name, _ in pending_teams)}")
+        # Button to insert all queued teams into the TEAMS table in a single round-trip
+        st.button("Save Teams", on_click=save_pending_teams, args=(engine,), disabled=not engine)
 
 # Container for adding a new car
 with st.container(border=True):
     st.header("Add a Car")
     col3, col4, col5 = st.columns(3)
     with col3:
-        car_model = st.text_input("Car Model")
-        top_speed = st.slider("Top Speed (km/h)", 100, 400, 250)
+        st.text_input("Car Model", key="car_model")
+        st.slider("Top Speed (km/h)", 100, 400, 250, key="top_speed")
     with col4:
-        acceleration = st.slider("Acceleration (0-100 km/h)", 1.0, 10.0, 5.0)
+        st.slider("Acceleration (0-100 km/h)", 1.0, 10.0, 5.0, key="acceleration")
     with col5:
-        handling = st.slider("Handling", 1.0, 10.0, 5.0)
+        st.slider("Handling", 1.0, 10.0, 5.0, key="handling")
 
     # Get the list of available teams for the dropdown from the loaded DataFrame
+    # The list is only cached for a successfully loaded frame, never for the empty fallback
     team_list = []
     if not teams_df.empty:
-        team_list = teams_df['TEAM_NAME'].unique()
+        team_list = team_name_list(teams_df, teams_version)
     
     if len(team_list) > 0:
-        assigned_team = st.selectbox("Assign to Team", team_list)
+        st.selectbox("Assign to Team", team_list, key="assigned_team")
         # Button to add the new car to the Snowflake table
-        if st.button("Add Car"):
-            if car_model and conn:
-                team_id = teams_df.loc[teams_df['TEAM_NAME'] == assigned_team, 'TEAM_ID'].iloc[0]
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute(f"INSERT INTO CARS.CARS (CAR_ID, CAR_MODEL, TOP_SPEED, ACCELERATION, HANDLING, ASSIGNED_TEAM_ID) VALUES ('{uuid.uuid4()}', '{car_model}', {top_speed}, {acceleration}, {handling}, '{team_id}')")
-                    conn.commit()
-                    st.success(f"Car '{car_model}' has been added to Snowflake!")
-                    st.cache_data.clear() # Clear cache to force data reload
-                    st.experimental_rerun()
-                except Exception as e:
-                    st.error(f"Failed to add car: {e}")
+        st.button("Add Car", on_click=add_car, args=(engine,), disabled=not engine)
     else:
         st.warning("Please add at least one team first.")
 
@@ -121,10 +329,10 @@ st.divider()
 col_view1, col_view2 = st.columns(2)
 with col_view1:
     st.header("Registered Teams")
-    st.dataframe(teams_df)
+    render_paginated(teams_df, "teams")
 with col_view2:
     st.header("Registered Cars")
-    st.dataframe(cars_df)
+    render_paginated(cars_df, "cars")
 
 st.divider()
 
@@ -132,53 +340,53 @@ st.divider()
 if st.button("🏁 Start Race", use_container_width=True, type="primary"):
     if teams_df.empty or cars_df.empty:
         st.error("You need at least one team and one car to start the race.")
-    elif conn:
+    elif engine:
         st.header("Race Results")
         
-        # Deduct race fee from all participating teams in a single transaction
-        try:
-            conn.cursor().execute(f"UPDATE TEAMS.TEAMS SET BUDGET = BUDGET - {RACE_FEE}")
-            conn.commit()
-        except Exception as e:
-            st.error(f"Failed to deduct race fees: {e}")
-            st.stop()
-        
-        race_results = []
-        with st.spinner("The race is starting..."):
-            time.sleep(2) # Simulate race duration
-            
-            for _, car_row in cars_df.iterrows():
-                # Calculate time taken based on car stats with randomness
-                time_taken = (100.0 / (car_row['TOP_SPEED'] * (1 + random.uniform(-0.1, 0.1)))) + \
-                             (10.0 / (car_row['ACCELERATION'] * (1 + random.uniform(-0.1, 0.1)))) + \
-                             (10.0 / (car_row['HANDLING'] * (1 + random.uniform(-0.1, 0.1))))
-                
-                race_results.append({
-                    "Car Model": car_row['CAR_MODEL'],
-                    "Team": teams_df.loc[teams_df['TEAM_ID'] == car_row['ASSIGNED_TEAM_ID'], 'TEAM_NAME'].iloc[0],
-                    "Time": f"{time_taken:.2f} sec",
-                    "Team ID": car_row['ASSIGNED_TEAM_ID']
-                })
-
-        # Sort results and determine the winner
-        results_df = pd.DataFrame(race_results).sort_values(by="Time")
+        # Run the race over every car and keep the fastest finishers
+        results_df = run_race(cars_df, RESULTS_LIMIT)
+
+        # Order results fastest first and take the winner from the top. The stable sort puts
+        # NaN times (cars with a NULL stat) last, so such a car can never win.
+        results_df = results_df.iloc[np.argsort(results_df['Time'].to_numpy(), kind='stable')]
         winner_info = results_df.iloc[0]
+        if np.isnan(winner_info['Time']):
+            st.error("No car has complete stats, so nobody can finish the race.")
+            st.stop()
         winner_team_id = winner_info['Team ID']
         winner_team_name = winner_info['Team']
-        
-        # Add prize money to the winning team's budget
+
+        # Deduct the race fee from all teams and pay the winner in a single statement
         try:
-            conn.cursor().execute(f"UPDATE TEAMS.TEAMS SET BUDGET = BUDGET + {PRIZE_MONEY} WHERE TEAM_ID = '{winner_team_id}'")
-            conn.commit()
+            with snowflake_connection(engine) as conn:
+                conn.cursor().execute(
+                    "UPDATE TEAMS.TEAMS SET BUDGET = BUDGET - ? + IFF(TEAM_ID = ?, ?, 0)",
+                    (RACE_FEE, winner_team_id, PRIZE_MONEY)
+                )
+                conn.commit()
+        except Exception as e:
+            st.error(f"Failed to settle race fees and prize money: {e}")
+            st.stop()
+        # The money has moved, so invalidate cached budgets before anything else can fail
+        bump_data_version("teams")
+
+        # Reload the new budgets for display. A failure here must not look like the race failed.
+        updated_teams_df = None
+        try:
+            updated_teams_df = fetch_dataframe(engine, TEAMS_QUERY, TEAM_DTYPES)
         except Exception as e:
-            st.error(f"Failed to update winner's budget: {e}")
+            st.warning(f"Race fees and prize money were settled, but reloading the budgets failed: {e}")
 
         # Display results and celebration effects
-        st.dataframe(results_df.drop('Team ID', axis=1), use_container_width=True)
+        display_df = results_df.drop('Team ID', axis=1)
+        display_df = display_df.assign(Time=display_df['Time'].map(lambda t: "DNF" if np.isnan(t) else f"{t:.2f} sec"))
+        st.dataframe(display_df, use_container_width=True)
         st.balloons()
         st.success(f"🎉 Team **{winner_team_name}** wins the race! 🎉")
 
-        st.subheader("Updated Team Budgets")
-        st.cache_data.clear() # Clear cache to force data reload
-        teams_df, _ = load_data(conn) # Reload data after updates
-        st.dataframe(teams_df, use_container_width=True)
+        if updated_teams_df is not None:
+            st.subheader("Updated Team Budgets")
+            # Page widgets would not survive the rerun they trigger here, so only the first page is shown
+            st.dataframe(updated_teams_df.head(PAGE_SIZE), use_container_width=True)
+            if len(updated_teams_df) > PAGE_SIZE:
+                st.caption(f"Showing the first {PAGE_SIZE} of {len(updated_teams_df)} teams. All budgets are listed under Registered Teams.")